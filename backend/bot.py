@@ -1,21 +1,25 @@
 import os
+import json
+import time
+import hashlib
 import logging
 import asyncio
+import importlib
 from fastapi import FastAPI, Request
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, contextmanager
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
-from bip_utils import Bip39MnemonicValidator
 
+# backend.hd_wallet (bip_utils) and backend.blockchain (web3) are slow to import, so they are loaded
+# on first use and warmed up in the background after startup instead of at module load.
 from backend.database import (
-    create_all_tables, add_seller, get_seller_by_telegram_id, set_seller_wallet, get_wallet_by_seller_id,
+    ensure_schema, ensure_deposit_partitions, get_bot_state, set_bot_state, add_seller, get_seller_by_telegram_id, set_seller_wallet, get_wallet_by_seller_id,
     add_product, get_seller_products_with_links, get_product_by_id, add_link_to_product, get_product_links,
     update_product_price, delete_product_link, update_seller_name, create_deposit_address,
-    get_pending_deposit_for_user, confirm_payment, get_next_address_index, get_deposit_by_id
+    get_pending_deposit_for_user, confirm_payment, get_next_address_index, get_deposit_by_id,
+    run_deposit_maintenance
 )
-from backend.hd_wallet import generate_new_address
-from backend.blockchain import check_payment_on_address
 
 # --- Initial Setup & Config ---
 load_dotenv()
@@ -24,13 +28,37 @@ logger = logging.getLogger(__name__)
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+# Unpaid deposits older than the TTL are marked 'expired'; monthly deposit partitions older than the
+# retention window are detached from the live table.
+DEPOSIT_TTL_MINUTES = int(os.getenv("DEPOSIT_TTL_MINUTES", "120"))
+DEPOSIT_RETENTION_MONTHS = int(os.getenv("DEPOSIT_RETENTION_MONTHS", "6"))
+DEPOSIT_MAINTENANCE_INTERVAL_SECONDS = int(os.getenv("DEPOSIT_MAINTENANCE_INTERVAL_SECONDS", "3600"))
 RPC_URLS = { chain: os.getenv(f"{chain}_RPC_URL") for chain in ["ETH", "POLYGON", "BASE", "ARBITRUM", "BSC"] }
 TOKEN_CONTRACTS = {
     "USDT": {"ETH": "0xdac17f958d2ee523a2206206994597c13d831ec7", "POLYGON": "0xc2132d05d31c914a87c6611c10748aeb04b58e8f", "BASE": "0xfde4C96c8593536E31F229EA8f37b2ADa2699bb2", "ARBITRUM": "0xfd086bc7cd5c481dcc9c85ebe478a1c0b69fcbb9", "BSC": "0x55d398326f99059ff775485246999027b3197955"},
     "USDC": {"ETH": "0xA0b86991c6218b36c1d19D4a2e9Eb0cE3606eB48", "POLYGON": "0x3c499c542cEF5E3811e1192ce70d8cC03d5c3359", "BASE": "0x833589fCD6eDb6E08f4c7C32D4f71b54bdA02913", "ARBITRUM": "0xaf88d065e77c8cC2239327C5EDb3A432268e5831", "BSC": "0x8ac76a51cc950d9822d68b83fe1ad97b32cd580d"}
 }
-
-application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+BOT_COMMANDS = [
+    ("register", "Create your seller account"),
+    ("myproducts", "List and manage your products"),
+    ("addproduct", "Create a new product bundle"),
+    ("addlink", "Add a link to a product"),
+    ("removelink", "Remove a link from a product"),
+    ("editprice", "Change a product's price"),
+    ("editshopname", "Change your shop name"),
+    ("setwallet", "Set your payment wallet"),
+]
+LAZY_MODULES = ["backend.hd_wallet", "backend.blockchain"]
+
+# Built in the lifespan rather than at import time.
+application = None
+# Started once the bot is ready; cancelled on shutdown.
+background_tasks = []
+
+async def load_lazy_module(module_name: str):
+    # Imports on a worker thread so a handler that runs before the warm-up finishes does not block
+    # the event loop for the duration of the import.
+    return await asyncio.to_thread(importlib.import_module, module_name)
 
 # --- Auth Decorator ---
 def is_seller(func):
@@ -76,9 +104,10 @@ async def edit_shop_name_command(update: Update, context: ContextTypes.DEFAULT_T
 
 @is_seller
 async def set_wallet_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    bip_utils = await load_lazy_module("bip_utils")
     mnemonic = " ".join(context.args)
     await update.message.delete()
-    if len(context.args) not in [12, 24] or not Bip39MnemonicValidator().IsValid(mnemonic):
+    if len(context.args) not in [12, 24] or not bip_utils.Bip39MnemonicValidator().IsValid(mnemonic):
         return await update.message.reply_text("❌ Invalid recovery phrase. Your message was deleted for security.")
     set_seller_wallet(context.user_data['seller_id'], mnemonic)
     await update.message.reply_text("✅ Wallet set. Your message was deleted.")
@@ -230,11 +259,18 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         wallet = get_wallet_by_seller_id(seller_id)
         if not wallet:
             return await query.edit_message_text("Seller has not configured their wallet.")
-        wallet_id, mnemonic = wallet["id"], wallet["mnemonic"]
-        next_index = get_next_address_index(wallet_id)
-        address = generate_new_address(mnemonic, next_index)
-        deposit_id = create_deposit_address(product_id, wallet_id, user_id, address, next_index)
+        # EVM addresses are the same on every chain, so a pending deposit can be reused across networks.
+        pending_deposit = get_pending_deposit_for_user(user_id, product_id, DEPOSIT_TTL_MINUTES)
+        if pending_deposit:
+            deposit_id, deposit_created_at, address = pending_deposit
+        else:
+            hd_wallet = await load_lazy_module("backend.hd_wallet")
+            wallet_id, mnemonic = wallet["id"], wallet["mnemonic"]
+            next_index = get_next_address_index(wallet_id)
+            address = hd_wallet.generate_new_address(mnemonic, next_index)
+            deposit_id, deposit_created_at = create_deposit_address(product_id, wallet_id, user_id, address, next_index)
         context.user_data['deposit_id'] = deposit_id
+        context.user_data['deposit_created_at'] = deposit_created_at
         keyboard = [
             [InlineKeyboardButton("✅ I Have Paid", callback_data=f"check_{chain}")],
             [InlineKeyboardButton("⬅️ Back", callback_data="show_chains")]
@@ -247,22 +283,24 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
     elif callback_data.startswith("check_"):
+        blockchain = await load_lazy_module("backend.blockchain")
         deposit_id = context.user_data.get('deposit_id')
-        if not deposit_id:
+        deposit_created_at = context.user_data.get('deposit_created_at')
+        if not deposit_id or not deposit_created_at:
             return await query.edit_message_text("Could not find an active deposit. Please restart.")
-        deposit_record = get_deposit_by_id(deposit_id)
+        deposit_record = get_deposit_by_id(deposit_id, deposit_created_at)
         if not deposit_record:
             return await query.edit_message_text("Deposit record not found.")
 
-        _, _, _, deposit_address = deposit_record
+        _, _, deposit_address = deposit_record
         chain = callback_data.split("_")[1]
         await query.edit_message_text(f"⏳ Scanning {chain} for your payment...")
         rpc_url = RPC_URLS.get(chain)
         tokens_to_check = {token: contract.get(chain) for token, contract in TOKEN_CONTRACTS.items() if contract.get(chain)}
-        coin_type, tx_hash, amount_paid = check_payment_on_address(chain, rpc_url, deposit_address, float(price), tokens_to_check)
+        coin_type, tx_hash, amount_paid = blockchain.check_payment_on_address(chain, rpc_url, deposit_address, float(price), tokens_to_check)
 
         if tx_hash:
-            confirm_payment(deposit_id, tx_hash, amount_paid, coin_type)
+            confirm_payment(deposit_id, deposit_created_at, tx_hash, amount_paid, coin_type)
             links = get_product_links(product_id)
             links_text = "\n".join(links)
             await query.edit_message_text(
@@ -279,38 +317,110 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 reply_markup=InlineKeyboardMarkup(keyboard)
             )
 
+# --- Background Jobs ---
+async def deposit_maintenance_loop():
+    while True:
+        try:
+            result = await asyncio.to_thread(run_deposit_maintenance, DEPOSIT_TTL_MINUTES, DEPOSIT_RETENTION_MONTHS)
+            if result is None:
+                logger.info("Deposit maintenance skipped: another instance is running it.")
+            else:
+                expired, archived = result
+                logger.info(f"Deposit maintenance: expired {expired} deposit(s), archived partitions {archived}.")
+        except Exception as e:
+            logger.error(f"Deposit maintenance failed: {e}")
+        await asyncio.sleep(DEPOSIT_MAINTENANCE_INTERVAL_SECONDS)
+
+# --- Startup ---
+@contextmanager
+def startup_phase(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        logger.info(f"Startup phase '{name}' took {(time.perf_counter() - started) * 1000:.0f} ms.")
+
+def state_fingerprint(value: str) -> str:
+    # Includes the bot token so switching bots always re-applies the state.
+    return hashlib.sha256(f"{TELEGRAM_BOT_TOKEN}|{value}".encode()).hexdigest()
+
+async def sync_remote_state(key: str, value: str, apply):
+    """
+    Calls `apply` only if `value` differs from what was applied on the last boot.
+    """
+    fingerprint = state_fingerprint(value)
+    if await asyncio.to_thread(get_bot_state, key) == fingerprint:
+        logger.info(f"Skipping {key}: unchanged since last boot.")
+        return
+    await apply()
+    await asyncio.to_thread(set_bot_state, key, fingerprint)
+
+async def verify_webhook(webhook_url: str):
+    """
+    The boot-time webhook skip trusts the stored fingerprint, but the webhook can be deleted or
+    replaced outside this process. Checks Telegram's actual state once the bot is serving.
+    """
+    try:
+        if (await application.bot.get_webhook_info()).url != webhook_url:
+            logger.warning("Webhook was changed outside this deployment, setting it again.")
+            await application.bot.set_webhook(url=webhook_url)
+            await asyncio.to_thread(set_bot_state, "webhook_url", state_fingerprint(webhook_url))
+    except Exception as e:
+        logger.error(f"Webhook verification failed: {e}")
+
+def build_application() -> Application:
+    bot_application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    bot_application.add_handler(CommandHandler("start", start_command))
+    bot_application.add_handler(CommandHandler("register", register_command))
+    bot_application.add_handler(CommandHandler("setwallet", set_wallet_command))
+    bot_application.add_handler(CommandHandler("addproduct", add_product_command))
+    bot_application.add_handler(CommandHandler("addlink", add_link_command))
+    bot_application.add_handler(CommandHandler("editprice", edit_price_command))
+    bot_application.add_handler(CommandHandler("removelink", remove_link_command))
+    bot_application.add_handler(CommandHandler("myproducts", my_products_command))
+    bot_application.add_handler(CommandHandler("editshopname", edit_shop_name_command))
+    bot_application.add_handler(CallbackQueryHandler(button_handler))
+    return bot_application
+
+def warm_up_lazy_modules():
+    for module_name in LAZY_MODULES:
+        with startup_phase(f"import {module_name}"):
+            importlib.import_module(module_name)
+
 # --- FastAPI Application ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    create_all_tables()
-
-    commands = [
-        BotCommand("register", "Create your seller account"),
-        BotCommand("myproducts", "List and manage your products"),
-        BotCommand("addproduct", "Create a new product bundle"),
-        BotCommand("addlink", "Add a link to a product"),
-        BotCommand("removelink", "Remove a link from a product"),
-        BotCommand("editprice", "Change a product's price"),
-        BotCommand("editshopname", "Change your shop name"),
-        BotCommand("setwallet", "Set your payment wallet"),
-    ]
-    await application.bot.set_my_commands(commands)
-
-    application.add_handler(CommandHandler("start", start_command))
-    application.add_handler(CommandHandler("register", register_command))
-    application.add_handler(CommandHandler("setwallet", set_wallet_command))
-    application.add_handler(CommandHandler("addproduct", add_product_command))
-    application.add_handler(CommandHandler("addlink", add_link_command))
-    application.add_handler(CommandHandler("editprice", edit_price_command))
-    application.add_handler(CommandHandler("removelink", remove_link_command))
-    application.add_handler(CommandHandler("myproducts", my_products_command))
-    application.add_handler(CommandHandler("editshopname", edit_shop_name_command))
-    application.add_handler(CallbackQueryHandler(button_handler))
-
-    await application.initialize()
-    if WEBHOOK_URL:
-        await application.bot.set_webhook(url=f"{WEBHOOK_URL}/telegram")
+    global application
+    started = time.perf_counter()
+    webhook_url = f"{WEBHOOK_URL}/telegram" if WEBHOOK_URL else None
+    with startup_phase("schema"):
+        await asyncio.to_thread(ensure_schema)
+        # Always runs, since create_all_tables() is skipped when the schema is current and the
+        # service may have been down across a month boundary.
+        await asyncio.to_thread(ensure_deposit_partitions)
+    with startup_phase("application"):
+        application = build_application()
+        await application.initialize()
+    with startup_phase("commands"):
+        await sync_remote_state(
+            "bot_commands", json.dumps(BOT_COMMANDS),
+            lambda: application.bot.set_my_commands([BotCommand(command, description) for command, description in BOT_COMMANDS])
+        )
+    if webhook_url:
+        with startup_phase("webhook"):
+            await sync_remote_state("webhook_url", webhook_url, lambda: application.bot.set_webhook(url=webhook_url))
+    logger.info(f"Bot ready in {(time.perf_counter() - started) * 1000:.0f} ms.")
+
+    # Not needed to serve the first update, so these run after startup.
+    background_tasks.append(asyncio.create_task(deposit_maintenance_loop()))
+    background_tasks.append(asyncio.create_task(asyncio.to_thread(warm_up_lazy_modules)))
+    if webhook_url:
+        background_tasks.append(asyncio.create_task(verify_webhook(webhook_url)))
     yield
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
     await application.shutdown()
 
 app = FastAPI(lifespan=lifespan)
@@ -1,5 +1,8 @@
 import os
+import re
+from datetime import datetime, timezone
 import psycopg2
+from psycopg2 import errors, sql
 from cryptography.fernet import Fernet
 from dotenv import load_dotenv
 
@@ -31,18 +34,215 @@ def decrypt_data(encrypted_data: bytes) -> str:
     return fernet.decrypt(encrypted_data).decode()
 
 # --- Table Creation ---
+# Bump SCHEMA_VERSION whenever create_all_tables() changes so existing deployments re-run it on boot.
+SCHEMA_VERSION = "3"
+SCHEMA_LOCK_ID = 7402651
+DEPOSIT_MAINTENANCE_LOCK_ID = 7402652
+
 def create_all_tables():
     conn = get_db_connection()
     cur = conn.cursor()
+    # Serialise migrations when several instances boot at the same time.
+    cur.execute("SELECT pg_advisory_xact_lock(%s);", (SCHEMA_LOCK_ID,))
+    # Also keep deposit maintenance from creating or detaching partitions while this runs.
+    cur.execute("SELECT pg_advisory_xact_lock(%s);", (DEPOSIT_MAINTENANCE_LOCK_ID,))
     cur.execute("CREATE TABLE IF NOT EXISTS sellers (id SERIAL PRIMARY KEY, telegram_user_id BIGINT UNIQUE NOT NULL, name VARCHAR(255) NOT NULL, created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP);")
     cur.execute("CREATE TABLE IF NOT EXISTS wallets (id SERIAL PRIMARY KEY, seller_id INT UNIQUE NOT NULL REFERENCES sellers(id) ON DELETE CASCADE, encrypted_mnemonic BYTEA NOT NULL, created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP);")
     cur.execute("CREATE TABLE IF NOT EXISTS products (id SERIAL PRIMARY KEY, seller_id INT NOT NULL REFERENCES sellers(id) ON DELETE CASCADE, name VARCHAR(255) NOT NULL, price NUMERIC(10, 2) NOT NULL, currency VARCHAR(10) NOT NULL DEFAULT 'USDT', is_active BOOLEAN DEFAULT TRUE, created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP);")
+    cur.execute("CREATE TABLE IF NOT EXISTS bot_state (key VARCHAR(64) PRIMARY KEY, value TEXT NOT NULL, updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP);")
     cur.execute("CREATE TABLE IF NOT EXISTS product_links (id SERIAL PRIMARY KEY, product_id INT NOT NULL REFERENCES products(id) ON DELETE CASCADE, invite_link TEXT NOT NULL);")
-    cur.execute("CREATE TABLE IF NOT EXISTS deposits (id SERIAL PRIMARY KEY, product_id INT NOT NULL REFERENCES products(id), wallet_id INT NOT NULL REFERENCES wallets(id), telegram_user_id BIGINT NOT NULL, address VARCHAR(255) UNIQUE NOT NULL, address_index INT NOT NULL, status VARCHAR(20) NOT NULL DEFAULT 'pending', coin_type VARCHAR(10), tx_hash VARCHAR(255), amount_received NUMERIC(36, 18), created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP, paid_at TIMESTAMP WITH TIME ZONE);")
+    is_migrating = _rename_legacy_deposits_table(cur)
+    # Deposits are range-partitioned by month on created_at. The primary key has to include the
+    # partition key, so address uniqueness is guaranteed by wallet_address_counters instead.
+    cur.execute("CREATE TABLE IF NOT EXISTS deposits (id SERIAL, product_id INT NOT NULL REFERENCES products(id), wallet_id INT NOT NULL REFERENCES wallets(id), telegram_user_id BIGINT NOT NULL, address VARCHAR(255) NOT NULL, address_index INT NOT NULL, status VARCHAR(20) NOT NULL DEFAULT 'pending', coin_type VARCHAR(10), tx_hash VARCHAR(255), amount_received NUMERIC(36, 18), created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP, paid_at TIMESTAMP WITH TIME ZONE, PRIMARY KEY (id, created_at)) PARTITION BY RANGE (created_at);")
+    cur.execute("CREATE INDEX IF NOT EXISTS deposits_pending_lookup_idx ON deposits (telegram_user_id, product_id, created_at) WHERE status = 'pending';")
+    cur.execute("CREATE INDEX IF NOT EXISTS deposits_pending_created_at_idx ON deposits (created_at) WHERE status = 'pending';")
+    cur.execute("CREATE INDEX IF NOT EXISTS deposits_address_idx ON deposits (address);")
+    cur.execute("CREATE TABLE IF NOT EXISTS wallet_address_counters (wallet_id INT PRIMARY KEY REFERENCES wallets(id) ON DELETE CASCADE, next_index INT NOT NULL);")
+    _create_deposit_partitions(cur, DEPOSIT_PARTITIONS_AHEAD)
+    if is_migrating:
+        _copy_legacy_deposits(cur)
+    # Seed every wallet's counter from all of its deposits before any partition can be detached,
+    # otherwise a wallet whose deposits were archived would restart at index 0 and reissue addresses.
+    cur.execute(
+        "INSERT INTO wallet_address_counters (wallet_id, next_index) SELECT wallet_id, MAX(address_index) + 1 FROM deposits GROUP BY wallet_id "
+        "ON CONFLICT (wallet_id) DO UPDATE SET next_index = GREATEST(wallet_address_counters.next_index, EXCLUDED.next_index);"
+    )
     conn.commit()
     cur.close()
     conn.close()
 
+def ensure_schema() -> bool:
+    """
+    Runs create_all_tables() only if the stored schema version differs from SCHEMA_VERSION.
+    Returns True if the schema was (re)applied.
+    """
+    if get_bot_state("schema_version") == SCHEMA_VERSION:
+        return False
+    create_all_tables()
+    set_bot_state("schema_version", SCHEMA_VERSION)
+    return True
+
+# --- Bot State Functions ---
+def get_bot_state(key: str):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT value FROM bot_state WHERE key = %s;", (key,))
+        row = cur.fetchone()
+    except errors.UndefinedTable:
+        # Fresh database: the schema has not been created yet.
+        conn.rollback()
+        row = None
+    finally:
+        cur.close()
+        conn.close()
+    return row[0] if row else None
+
+def set_bot_state(key: str, value: str):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("INSERT INTO bot_state (key, value) VALUES (%s, %s) ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = CURRENT_TIMESTAMP;", (key, value))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+# --- Deposit Partitioning ---
+# Monthly partitions are named deposits_pYYYY_MM and cover [first of month, first of next month) in UTC.
+DEPOSIT_PARTITIONS_AHEAD = 1
+DEPOSIT_PARTITION_PATTERN = re.compile(r"^deposits_p(\d{4})_(\d{2})$")
+
+def _add_months(month_start: datetime, months: int) -> datetime:
+    month_number = month_start.year * 12 + month_start.month - 1 + months
+    return month_start.replace(year=month_number // 12, month=month_number % 12 + 1)
+
+def _current_month_start() -> datetime:
+    return datetime.now(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def _deposit_partition_name(month_start: datetime) -> str:
+    return f"deposits_p{month_start.year:04d}_{month_start.month:02d}"
+
+def _create_deposit_partition(cur, month_start: datetime):
+    cur.execute(
+        sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF deposits FOR VALUES FROM (%s) TO (%s);").format(sql.Identifier(_deposit_partition_name(month_start))),
+        (month_start.isoformat(), _add_months(month_start, 1).isoformat())
+    )
+
+def _create_deposit_partitions(cur, months_ahead: int):
+    current_month = _current_month_start()
+    for offset in range(months_ahead + 1):
+        _create_deposit_partition(cur, _add_months(current_month, offset))
+
+def _rename_legacy_deposits_table(cur) -> bool:
+    """
+    Moves an unpartitioned deposits table created by older releases out of the way so the
+    partitioned table can take its name. Returns True if there is legacy data to copy.
+    """
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('deposits');")
+    row = cur.fetchone()
+    if row is None or row[0] == 'p':
+        return False
+    cur.execute("ALTER TABLE deposits RENAME TO deposits_legacy;")
+    cur.execute("ALTER SEQUENCE IF EXISTS deposits_id_seq RENAME TO deposits_legacy_id_seq;")
+    cur.execute("ALTER INDEX IF EXISTS deposits_pkey RENAME TO deposits_legacy_pkey;")
+    cur.execute("ALTER INDEX IF EXISTS deposits_address_key RENAME TO deposits_legacy_address_key;")
+    return True
+
+def _copy_legacy_deposits(cur):
+    cur.execute("SELECT DISTINCT date_trunc('month', COALESCE(created_at, CURRENT_TIMESTAMP) AT TIME ZONE 'UTC') FROM deposits_legacy;")
+    for (month_start,) in cur.fetchall():
+        _create_deposit_partition(cur, month_start.replace(tzinfo=timezone.utc))
+    cur.execute("""
+        INSERT INTO deposits (id, product_id, wallet_id, telegram_user_id, address, address_index, status, coin_type, tx_hash, amount_received, created_at, paid_at)
+        SELECT id, product_id, wallet_id, telegram_user_id, address, address_index, status, coin_type, tx_hash, amount_received, COALESCE(created_at, CURRENT_TIMESTAMP), paid_at
+        FROM deposits_legacy;
+    """)
+    cur.execute("SELECT setval(pg_get_serial_sequence('deposits', 'id'), COALESCE((SELECT MAX(id) FROM deposits), 0) + 1, false);")
+    cur.execute("DROP TABLE deposits_legacy;")
+
+def ensure_deposit_partitions(months_ahead: int = DEPOSIT_PARTITIONS_AHEAD):
+    """
+    Creates the current and upcoming monthly partitions if any are missing. Skips the DDL if
+    another instance holds the maintenance lock, since that instance is creating them already.
+    """
+    current_month = _current_month_start()
+    partition_names = [_deposit_partition_name(_add_months(current_month, offset)) for offset in range(months_ahead + 1)]
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT bool_and(to_regclass(name) IS NOT NULL) FROM unnest(%s::text[]) AS name;", (partition_names,))
+    if not cur.fetchone()[0]:
+        cur.execute("SELECT pg_try_advisory_xact_lock(%s);", (DEPOSIT_MAINTENANCE_LOCK_ID,))
+        if cur.fetchone()[0]:
+            _create_deposit_partitions(cur, months_ahead)
+    conn.commit()
+    cur.close()
+    conn.close()
+
+def _archive_deposit_partition(cur, partition_name: str) -> str:
+    archive_name = partition_name.replace("deposits_p", "deposits_archive_", 1)
+    cur.execute(sql.SQL("ALTER TABLE {} RENAME TO {};").format(sql.Identifier(partition_name), sql.Identifier(archive_name)))
+    return archive_name
+
+def _detach_old_deposit_partitions(cur, retention_months: int, concurrently: bool) -> list:
+    cutoff = _add_months(_current_month_start(), -retention_months)
+    if concurrently:
+        # An interrupted DETACH ... CONCURRENTLY leaves the partition pending detach, which blocks
+        # further detaches until it is finalized, so those are handled first.
+        cur.execute("SELECT c.relname, i.inhdetachpending FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = 'deposits'::regclass ORDER BY i.inhdetachpending DESC;")
+        detach_sql = "ALTER TABLE deposits DETACH PARTITION {} CONCURRENTLY;"
+    else:
+        cur.execute("SELECT c.relname, FALSE FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = 'deposits'::regclass;")
+        detach_sql = "ALTER TABLE deposits DETACH PARTITION {};"
+    for partition_name, is_detach_pending in cur.fetchall():
+        if is_detach_pending:
+            cur.execute(sql.SQL("ALTER TABLE deposits DETACH PARTITION {} FINALIZE;").format(sql.Identifier(partition_name)))
+            continue
+        match = DEPOSIT_PARTITION_PATTERN.match(partition_name)
+        if not match:
+            continue
+        month_start = datetime(int(match.group(1)), int(match.group(2)), 1, tzinfo=timezone.utc)
+        if _add_months(month_start, 1) > cutoff:
+            continue
+        cur.execute(sql.SQL(detach_sql).format(sql.Identifier(partition_name)))
+
+    # Rename every detached deposits_pYYYY_MM table, including ones whose rename failed on a previous run.
+    cur.execute(
+        "SELECT relname FROM pg_class WHERE relkind = 'r' AND NOT relispartition AND relnamespace = current_schema()::regnamespace "
+        "AND relname ~ '^deposits_p[0-9]{4}_[0-9]{2}$';"
+    )
+    return [_archive_deposit_partition(cur, partition_name) for (partition_name,) in cur.fetchall()]
+
+def run_deposit_maintenance(ttl_minutes: int, retention_months: int):
+    """
+    Creates upcoming deposit partitions, expires unpaid deposits older than `ttl_minutes` and
+    detaches partitions that ended more than `retention_months` ago, renaming them to
+    deposits_archive_YYYY_MM. The archived data is kept, but no longer scanned by live queries.
+
+    Only one instance runs this at a time. Returns (expired_count, archived_partitions), or None
+    if another instance holds the maintenance lock.
+    """
+    conn = get_db_connection()
+    # DETACH PARTITION ... CONCURRENTLY cannot run inside a transaction block, so this uses
+    # autocommit with a session-level advisory lock instead of a transaction-level one.
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT pg_try_advisory_lock(%s);", (DEPOSIT_MAINTENANCE_LOCK_ID,))
+        if not cur.fetchone()[0]:
+            return None
+        try:
+            _create_deposit_partitions(cur, DEPOSIT_PARTITIONS_AHEAD)
+            cur.execute("UPDATE deposits SET status = 'expired' WHERE status = 'pending' AND created_at <= CURRENT_TIMESTAMP - make_interval(mins => %s);", (ttl_minutes,))
+            expired_rows = cur.rowcount
+            # CONCURRENTLY (PostgreSQL 14+) avoids holding an ACCESS EXCLUSIVE lock on deposits.
+            archived = _detach_old_deposit_partitions(cur, retention_months, concurrently=conn.server_version >= 140000)
+        finally:
+            cur.execute("SELECT pg_advisory_unlock(%s);", (DEPOSIT_MAINTENANCE_LOCK_ID,))
+        return expired_rows, archived
+    finally:
+        cur.close()
+        conn.close()
+
 # --- Seller & Wallet Functions ---
 def add_seller(name, telegram_user_id):
     conn = get_db_connection()
@@ -194,49 +394,68 @@ def delete_product_link(link_id, seller_id):
     
 # --- Deposit Functions ---
 def get_next_address_index(wallet_id: int) -> int:
+    """
+    Atomically reserves the next HD derivation index for a wallet.
+
+    Counters for existing wallets are seeded by create_all_tables(); a wallet without a counter
+    has never issued an address and starts at index 0.
+    """
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute("SELECT MAX(address_index) FROM deposits WHERE wallet_id = %s;", (wallet_id,))
-    max_index = cur.fetchone()[0]
+    cur.execute(
+        "INSERT INTO wallet_address_counters (wallet_id, next_index) VALUES (%s, 1) "
+        "ON CONFLICT (wallet_id) DO UPDATE SET next_index = wallet_address_counters.next_index + 1 RETURNING next_index - 1;",
+        (wallet_id,)
+    )
+    row = cur.fetchone()
+    conn.commit()
     cur.close()
     conn.close()
-    return (max_index + 1) if max_index is not None else 0
+    return row[0]
 
-def create_deposit_address(product_id: int, wallet_id: int, telegram_user_id: int, address: str, address_index: int) -> int:
+def create_deposit_address(product_id: int, wallet_id: int, telegram_user_id: int, address: str, address_index: int):
+    """
+    Returns (id, created_at). Later lookups pass both so the planner can prune partitions.
+    """
     conn = get_db_connection()
     cur = conn.cursor()
     cur.execute(
-        "INSERT INTO deposits (product_id, wallet_id, telegram_user_id, address, address_index) VALUES (%s, %s, %s, %s, %s) RETURNING id;",
+        "INSERT INTO deposits (product_id, wallet_id, telegram_user_id, address, address_index) VALUES (%s, %s, %s, %s, %s) RETURNING id, created_at;",
         (product_id, wallet_id, telegram_user_id, address, address_index)
     )
-    deposit_id = cur.fetchone()[0]
+    deposit_key = cur.fetchone()
     conn.commit()
     cur.close()
     conn.close()
-    return deposit_id
+    return deposit_key
 
-def get_pending_deposit_for_user(telegram_user_id: int, product_id: int):
+def get_pending_deposit_for_user(telegram_user_id: int, product_id: int, max_age_minutes: int):
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute("SELECT id, address FROM deposits WHERE telegram_user_id = %s AND product_id = %s AND status = 'pending';", (telegram_user_id, product_id))
+    # Bounding created_at lets the planner prune partitions older than the deposit TTL.
+    cur.execute(
+        "SELECT id, created_at, address FROM deposits WHERE telegram_user_id = %s AND product_id = %s AND status = 'pending' "
+        "AND created_at > CURRENT_TIMESTAMP - make_interval(mins => %s) ORDER BY created_at DESC LIMIT 1;",
+        (telegram_user_id, product_id, max_age_minutes)
+    )
     deposit = cur.fetchone()
     cur.close()
     conn.close()
     return deposit
 
-def get_deposit_by_id(deposit_id: int):
+def get_deposit_by_id(deposit_id: int, created_at: datetime):
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute("SELECT product_id, seller_id, wallet_id, address FROM deposits WHERE id = %s;", (deposit_id,))
+    cur.execute("SELECT product_id, wallet_id, address FROM deposits WHERE id = %s AND created_at = %s;", (deposit_id, created_at))
     deposit = cur.fetchone()
     cur.close()
     conn.close()
     return deposit
 
-def confirm_payment(deposit_id: int, tx_hash: str, amount_received: float, coin_type: str):
+def confirm_payment(deposit_id: int, created_at: datetime, tx_hash: str, amount_received: float, coin_type: str):
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute("UPDATE deposits SET status = 'paid', tx_hash = %s, amount_received = %s, coin_type = %s, paid_at = CURRENT_TIMESTAMP WHERE id = %s;", (tx_hash, amount_received, coin_type, deposit_id))
+    cur.execute("UPDATE deposits SET status = 'paid', tx_hash = %s, amount_received = %s, coin_type = %s, paid_at = CURRENT_TIMESTAMP WHERE id = %s AND created_at = %s;", (tx_hash, amount_received, coin_type, deposit_id, created_at))
     conn.commit()
     cur.close()
     conn.close()